@@ -1,6 +1,189 @@
+import functools
 import numpy as np
-import skimage 
-import scipy.ndimage
+import scipy.spatial
+import cc3d
+from numba import njit, prange
+
+# Labels given to vesicles whose centres are provided as coordinates
+POS_LABEL = 1
+NEG_LABEL = 2
+
+# Optional GPU support, only used if cupy is installed.
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
+# GPU version of _stamp_balls, with one thread per (z,y) row of out, each drawing 
+# the balls in the order of centres so the later centre's label is kept. Each row 
+# of the ball, (dz,dy) from its centre, covers the offsets row_start <= dx < row_stop.
+_STAMP_BALLS_GPU_CODE = """
+template<typename T>
+__global__ void stamp_balls(T* out, const long long* centres, const T* labels, 
+                            long long num_centres, const long long* row_start, 
+                            const long long* row_stop, long long lz, long long ly, 
+                            long long nz, long long ny, long long Z, long long Y, 
+                            long long X) {
+    long long row = (long long)blockIdx.x*blockDim.x + threadIdx.x;
+    if (row >= Z*Y) {
+        return;
+    }
+    long long z = row / Y;
+    long long y = row % Y;
+    for (long long k = 0; k < num_centres; k++) {
+        long long dz = z - centres[3*k] - lz;
+        long long dy = y - centres[3*k + 1] - ly;
+        if (dz < 0 || dz >= nz || dy < 0 || dy >= ny) {
+            continue;
+        }
+        long long r = dz*ny + dy;
+        long long start = centres[3*k + 2] + row_start[r];
+        long long stop = centres[3*k + 2] + row_stop[r];
+        start = start < 0 ? 0 : start;
+        stop = stop > X ? X : stop;
+        for (long long x = start; x < stop; x++) {
+            out[row*X + x] = labels[k];
+        }
+    }
+}
+"""
+
+# C types of the ground truth dtypes the GPU kernel is compiled for
+_GPU_TYPENAMES = {
+    np.dtype(np.uint8): 'unsigned char', 
+    np.dtype(np.uint16): 'unsigned short', 
+    np.dtype(np.int32): 'int', 
+    np.dtype(np.int64): 'long long', 
+}
+
+_stamp_balls_gpu_module = None
+
+def _stamp_balls_gpu(dtype):
+    """
+        Return the GPU stamping kernel for arrays of the given dtype, compiling 
+        the kernels on first use.
+    """
+
+    global _stamp_balls_gpu_module
+    if dtype not in _GPU_TYPENAMES:
+        raise ValueError(f'Cannot draw balls on the GPU in an array of dtype {dtype}.')
+    if _stamp_balls_gpu_module is None:
+        _stamp_balls_gpu_module = cupy.RawModule(
+                    code=_STAMP_BALLS_GPU_CODE, 
+                    name_expressions=[f'stamp_balls<{name}>' for name in _GPU_TYPENAMES.values()])
+    return _stamp_balls_gpu_module.get_function(f'stamp_balls<{_GPU_TYPENAMES[dtype]}>')
+
+def gpu_available():
+    """
+        Check whether cupy is installed and a CUDA device can be found.
+    """
+
+    if cupy is None:
+        return False
+    try:
+        return cupy.cuda.runtime.getDeviceCount() > 0
+    except cupy.cuda.runtime.CUDARuntimeError:
+        return False
+
+
+@functools.lru_cache(maxsize=None)
+def ball_offsets(diameter):
+    """
+        Build a ball (ellipsoid) with the given (z,y,x) diameter in voxels and 
+        return the offset of each of its voxels from the ball centre. Results are cached, 
+        so the ball is only built once per diameter.
+
+        Parameters
+        -------------------
+        diameter (tuple(int)):
+            The size (in voxels) of the ball along each axis.
+
+        Returns 
+        -------------------
+        offsets (ndarray):
+            Read only array of shape (P, 3) with the offset of each ball voxel.
+    """
+
+    # Voxel centres inside the ellipsoid with radii diameter/2, centred in the box
+    radius = np.array(diameter)/2
+    grid = np.ogrid[tuple(slice(0, d) for d in diameter)]
+    ball = sum(((g + 0.5 - r)/r)**2 for g, r in zip(grid, radius)) <= 1
+
+    # np.argwhere gives the offsets in C order (z, then y, then x), so stamping them 
+    # in turn walks through C-contiguous memory with the smallest stride innermost
+    offsets = np.argwhere(ball) - np.array(diameter)//2
+    offsets.flags.writeable = False
+    return offsets
+
+
+@njit(parallel=True, cache=True, boundscheck=False)
+def _stamp_balls(out, centres, ball_offsets, flat_offsets, labels):
+    """
+        Set the voxels of a ball around each of centres in the C-contiguous 3D 
+        array out to the corresponding value in labels, skipping voxels past the 
+        boundary. Balls lying inside out along y and x are written directly through 
+        flat_offsets, the offsets of the ball voxels into the flattened array. 
+        The z slices of out are processed in parallel, each drawing the balls in 
+        the order of centres, so where balls overlap the later centre's label is 
+        kept, exactly as if the balls were drawn one after another.
+    """
+
+    Z, Y, X = out.shape
+    flat_out = out.reshape(-1)
+
+    # Extent of the ball about its centre along each axis
+    lower = np.zeros(3, dtype=np.int64)
+    upper = np.zeros(3, dtype=np.int64)
+    for p in range(ball_offsets.shape[0]):
+        for axis in range(3):
+            lower[axis] = min(lower[axis], ball_offsets[p, axis])
+            upper[axis] = max(upper[axis], ball_offsets[p, axis])
+
+    # The offsets are in C order, so the voxels of the ball in the slice dz from 
+    # its centre are ball_offsets[start[dz - lower[0]]:start[dz - lower[0] + 1]]
+    start = np.zeros(upper[0] - lower[0] + 2, dtype=np.int64)
+    for p in range(ball_offsets.shape[0]):
+        start[ball_offsets[p, 0] - lower[0] + 1] += 1
+    for i in range(1, start.shape[0]):
+        start[i] += start[i - 1]
+
+    for z in prange(Z):
+        for k in range(centres.shape[0]):
+            cz, cy, cx = centres[k, 0], centres[k, 1], centres[k, 2]
+            dz = z - cz
+            if dz < lower[0] or dz > upper[0]:
+                continue
+            first, last = start[dz - lower[0]], start[dz - lower[0] + 1]
+            if (cy + lower[1] >= 0 and cy + upper[1] < Y 
+                    and cx + lower[2] >= 0 and cx + upper[2] < X):
+                base = (cz*Y + cy)*X + cx
+                for p in range(first, last):
+                    flat_out[base + flat_offsets[p]] = labels[k]
+            else:
+                for p in range(first, last):
+                    y = cy + ball_offsets[p, 1]
+                    x = cx + ball_offsets[p, 2]
+                    if 0 <= y < Y and 0 <= x < X:
+                        out[z, y, x] = labels[k]
+
+
+@njit(cache=True)
+def _keep_greedily(num_centres, pairs):
+    """
+        Given the pairs (i, j), i < j, of centres that are too close together, 
+        sorted by i, keep each centre unless it is too close to an earlier centre 
+        that was kept.
+    """
+
+    keep = np.ones(num_centres, dtype=np.bool_)
+    q = 0
+    for i in range(num_centres):
+        while q < pairs.shape[0] and pairs[q, 0] == i:
+            if keep[i]:
+                keep[pairs[q, 1]] = False
+            q += 1
+    return keep
+
 
 class GroundTruth():
     """"
@@ -13,6 +196,12 @@ class GroundTruth():
             An array labelling the vesicle centres for PC+ vesicles.
         neg_data (array): 
             An array labelling the vesicle centres for PC- vesicles.
+        pos_centres (array):
+            Array of shape (N, 3) with the coordinates of PC+ vesicle centres.
+        neg_centres (array):
+            Array of shape (N, 3) with the coordinates of PC- vesicle centres.
+        shape (tuple(int)):
+            The shape of the ground truth array.
         voxel_size (tuple(int)): 
             Tuple containing the (z,y,x) resolution.
         offset (tuple(int)): 
@@ -30,14 +219,17 @@ class GroundTruth():
             result to zarr data. Default is ['z','y','x'].
         balls (dict): 
             Dictionary who's key is the diameter of a ball and value is 
-            the corresponding skimage ball (see 'draw_ball' function).
+            the offsets of the voxels in the corresponding ball 
+            from its centre (see 'ball_offsets' function).
         min_distance (int): 
             The minimum distance between two vesicle centre labels to be 
             considered separate vesicle labels (i.e. independent spheres).
         kernel_shape (array):
             The size (in voxels) of the spheres to be drawn.
         ground_truth (array):
-            The array containing the computed ground truth data.
+            The uint8 array containing the computed ground truth data.
+        device (str):
+            The device the ground truth is computed on, either 'cpu' or 'cuda'.
     """
      
     def __init__(self,
@@ -49,7 +241,11 @@ class GroundTruth():
                  background_label = 0, 
                  num_classes = 3, 
                  axes =['z','y','x'], 
-                 min_distance = 1):
+                 min_distance = 1, 
+                 device = 'cpu', 
+                 pos_centres = None, 
+                 neg_centres = None, 
+                 shape = None):
         
         """
             Initialise a groundtruth object. 
@@ -57,9 +253,11 @@ class GroundTruth():
             Parameters
             -------------------
             pos_data (array):
-                Array containing hand labelled PC+ vesicle centres.
+                Array containing hand labelled PC+ vesicle centres. Can be None 
+                if pos_centres is given instead.
             neg_data (array):
-                Array containing hand labelled PC- vesicle centres.
+                Array containing hand labelled PC- vesicle centres. Can be None 
+                if neg_centres is given instead.
             vesicle_diameter (int):
                 Requested real world diameter of vesicle spheres -- can be
                 in any unit as long as matches 'resolution'. 
@@ -74,36 +272,87 @@ class GroundTruth():
                 converting result to zarr data. Default is 0. 
             num_classes (int): 
                 The number of different label options, including background.
-                Required only for converting result to zarr data. Default is
+                Required only for converting result to zarr data. Must be at 
+                most 256, as the ground truth is stored as uint8. Default is
                 3 (PC+, PC-, background)
             axes (list(str)): 
                 List containing axes order for the data. Required only for converting 
                 result to zarr data. Default is ['z','y','x'].
             balls (dict): 
                 Dictionary who's key is the diameter of a ball and value is 
-                the corresponding skimage ball (see 'draw_ball' function).
+                the offsets of the voxels in the corresponding ball 
+                from its centre (see 'ball_offsets' function).
             min_distance (int): 
                 The minimum distance between two vesicle centre labels to be 
                 considered separate vesicle labels (i.e. independent spheres).
+            device (str): 
+                Either 'cpu' or 'cuda'. If 'cuda', the ground truth balls are drawn 
+                on the GPU using cupy. Only used if a CUDA device is available, 
+                otherwise falls back to the CPU. Default is 'cpu'.
+            pos_centres (array): 
+                Array of shape (N, 3) with the coordinates of PC+ vesicle centres, 
+                e.g. from a Napari points layer. These are used directly, without 
+                needing find_centres, and given label POS_LABEL. Default is None.
+            neg_centres (array): 
+                As pos_centres, for PC- vesicle centres, which are given label 
+                NEG_LABEL. Default is None.
+            shape (tuple(int)):
+                The shape of the ground truth array. Only required if neither 
+                pos_data nor neg_data are given. Default is None.
         """
 
         self.pos_data = pos_data
         self.neg_data = neg_data
+        self.pos_centres = pos_centres
+        self.neg_centres = neg_centres
+        if shape is None:
+            shape = (pos_data if pos_data is not None else neg_data).shape
+        self.shape = tuple(shape)
         self.voxel_size = resolution
         self.offset = offset
         self.background_label = background_label
+        if num_classes > np.iinfo(np.uint8).max + 1:
+            raise ValueError(
+                f'num_classes must be at most 256 to store the ground truth as uint8, not {num_classes}.')
         self.num_classes = num_classes
         self.axes = axes 
         self.balls = {}
         self.min_distance = min_distance
+        if device not in ('cpu', 'cuda'):
+            raise ValueError(f"device must be 'cpu' or 'cuda', not {device!r}.")
+        self.device = 'cuda' if device == 'cuda' and gpu_available() else 'cpu'
 
         diameter = np.array([vesicle_diameter, vesicle_diameter, vesicle_diameter])
         self.kernel_shape = np.ceil(diameter/self.voxel_size)
+
+        # Build the ball to be drawn once, up front
+        ball_diameter = tuple(int(x) for x in self.kernel_shape)
+        self.balls[ball_diameter] = ball_offsets(ball_diameter)
         
+    def label_components(self, data):
+        """
+            Label the connected components of the hand labelled data, using cc3d.
+
+            Parameters
+            -------------------
+            data (array): 
+                The hand labelled vesicle centre data.
+
+            Returns 
+            -------------------
+            labels (ndarray):
+                Array in which each connected component of data has a unique label.
+        """
+
+        return cc3d.connected_components(data, connectivity=26)
+
     def find_centres(self, data):
         """
-            Find centres of hand labelled data. Convolves data with a ball 
-            of size kernel_shape and looks for peak_local_max values. 
+            Find centres of hand labelled data. Each connected component of the 
+            hand labelled data (e.g. one painted dot) gives a single centre: the 
+            voxel of the component closest to its centroid. Centres of the same 
+            class within min_distance voxels of each other are then merged, keeping 
+            the centre of the larger component.
 
             Parameters
             -------------------
@@ -113,88 +362,138 @@ class GroundTruth():
             Returns 
             -------------------
             centre_indices (ndarry):
-                Vesicle centre coordinates, as given by skimage.feature.peak_local_max.
+                Array of shape (N, data.ndim) with the vesicle centre coordinates, 
+                ordered from largest to smallest component.
         """
 
-        kernel = skimage.morphology.ball(100).astype(np.float64) 
-        kernel = skimage.transform.resize(kernel, self.kernel_shape).astype(np.float64)
+        labels = self.label_components(data)
 
-        # Convolve the prediction with a spherical kernel
-        data_convolved = scipy.ndimage.convolve(data*5, kernel)
+        # Hand labelled voxels are sparse, so group them by component rather than 
+        # passing over the full volume once per component
+        flat_voxels = np.flatnonzero(data)
+        voxels = np.stack(np.unravel_index(flat_voxels, data.shape), axis=-1)
+        components = labels.reshape(-1)[flat_voxels].astype(np.int64) - 1
+        voxel_counts = np.bincount(components)
+        centroids = np.stack([np.bincount(components, weights=v) for v in voxels.T], 
+                             axis=-1) / voxel_counts[:, None]
 
-        # Find the indices for the peak local maxima
-        centre_indices = skimage.feature.peak_local_max(
-                                                    data_convolved, 
-                                                    min_distance = self.min_distance, 
-                                                    labels= skimage.measure.label(data)
-                                                    )
+        # The centroid of a curved stroke can lie outside it, so take the closest 
+        # voxel that is actually hand labelled, ties going to the first in C order
+        sampling = np.asarray(self.voxel_size, dtype=np.float64)
+        distance = (((voxels - centroids[components])*sampling)**2).sum(axis=1)
+        order = np.lexsort((distance, components))
+        first = np.flatnonzero(np.diff(components[order], prepend=-1))
+        centre_indices = voxels[order[first]].reshape(-1, data.ndim)
 
-        
+        # Order components largest first, so the merging below is deterministic
+        centre_indices = centre_indices[np.argsort(-voxel_counts, kind='stable')]
+        return self.merge_centres(centre_indices, data[tuple(centre_indices.T)])
+
+    def merge_centres(self, centres, classes):
+        """
+            Merge centres of the same class that are within min_distance voxels of 
+            each other (along every axis), so that separate vesicle centres are more 
+            than min_distance voxels apart along some axis, as with peak_local_max. 
+            Centres are kept greedily in the order given.
+
+            Parameters
+            -------------------
+            centres (array): 
+                Array of shape (N, 3) with the candidate centre coordinates.
+            classes (array):
+                Array of shape (N,) with the hand labelled class of each centre. 
+                Centres of different classes are never merged.
 
-        return centre_indices
+            Returns 
+            -------------------
+            centres (ndarray):
+                The centres that were kept, in the order given.
+        """
+
+        if self.min_distance < 1:
+            return centres
+
+        keep = np.ones(len(centres), dtype=bool)
+        for value in np.unique(classes):
+            members = np.flatnonzero(classes == value)
+            pairs = scipy.spatial.cKDTree(centres[members]).query_pairs(
+                            r=self.min_distance, p=np.inf, output_type='ndarray')
+            pairs = pairs[np.argsort(pairs[:, 0], kind='stable')]
+            keep[members] = _keep_greedily(len(members), pairs.astype(np.int64))
+
+        return centres[keep]
     
-    def draw_ball(self, array, location, label=1):
+    def draw_ball(self, array, locations, labels):
         """
-            Draw a ball of shape kernel_shape centred at location inside 
-            array, with value label. The array itself will be edited.
+            Draw a ball of shape kernel_shape centred at each of locations inside 
+            array, with the corresponding value from labels. Balls going past the 
+            boundary of the array are trimmed. The array itself will be edited.
 
             Parameters 
             -------------------
             array:
-                The array in which the ball should be drawn. 
-            location:
-                The indices for the centre of the ball. 
-            label (optional): 
-                The label value the ball should take. Default=1.
+                The C-contiguous 3D array in which the balls should be drawn. If 
+                this is a cupy array, the balls are drawn on the GPU.
+            locations:
+                Array of shape (N, array.ndim) with the indices for the centre 
+                of each ball. 
+            labels: 
+                Array of shape (N,) with the label value each ball should take.
         """
 
-        diameter = self.kernel_shape
-        diameter = tuple(int(x) for x in diameter)
-        # Check to see if we already have a ball of this size
-        if diameter not in self.balls:
-            ball = skimage.morphology.ball(100, dtype=bool)
-            ball = skimage.transform.resize(
-                                            ball, 
-                                            diameter, 
-                                            order=0, 
-                                            anti_aliasing=False).astype(bool) 
-            self.balls[diameter] = ball
-        
-        else: 
-            ball = self.balls[diameter]
+        offsets = self.balls[tuple(int(x) for x in self.kernel_shape)]
 
-        
-        # Check for ball going past the boundary and trim ball accordingly. 
-        slices_list = []
-        ball_slices_list = []
-        for loc, d, boundary, ball_shape in zip(location, diameter, array.shape, ball.shape):
-            ball_start = (loc - d//2)
-            ball_end = (loc - d//2 +d) 
-            ball_trim_start = 0 
-            ball_trim_end = ball_shape 
-
-            if (ball_start < 0):
-                ball_trim_start = -1*ball_start
-                ball_start = 0
-            if (ball_end > boundary):
-                ball_trim_end = boundary - ball_end 
-                ball_end = boundary
-            
-            slices_list.append(slice(ball_start, ball_end))
-            ball_slices_list.append(slice(ball_trim_start, ball_trim_end))
-        
-        slices = tuple(slices_list)
-        ball_slices = tuple(ball_slices_list)
+        if cupy is not None and isinstance(array, cupy.ndarray):
+            self._draw_ball_gpu(array, locations, labels, offsets)
+            return
+
+        if not array.flags.c_contiguous:
+            raise ValueError('The array to draw balls in must be C-contiguous.')
+
+        # Offsets of the ball voxels into the flattened array
+        flat_offsets = offsets @ np.array([array.shape[1]*array.shape[2], array.shape[2], 1])
 
-        # Go to ball location in array and set values to label
-        view = array[slices]
-        sliced_ball = ball[ball_slices]
-        view[sliced_ball] = label
+        _stamp_balls(
+                    array, 
+                    np.ascontiguousarray(locations, dtype=np.int64), 
+                    offsets, 
+                    flat_offsets, 
+                    np.asarray(labels, dtype=array.dtype))
+
+    def _draw_ball_gpu(self, array, locations, labels, offsets):
+        """
+            GPU version of draw_ball for a cupy array. Where balls overlap, the 
+            label of the later location is kept, matching the CPU version.
+        """
+
+        # Every (dz,dy) row of the (convex) ball is a single run of dx offsets
+        lower, upper = offsets.min(axis=0), offsets.max(axis=0)
+        nz, ny = upper[:2] - lower[:2] + 1
+        rows = (offsets[:, 0] - lower[0])*ny + (offsets[:, 1] - lower[1])
+        # Rows the ball does not reach are left empty, with row_start > row_stop
+        row_start = np.full(nz*ny, upper[2] + 1, dtype=np.int64)
+        row_stop = np.full(nz*ny, lower[2], dtype=np.int64)
+        np.minimum.at(row_start, rows, offsets[:, 2])
+        np.maximum.at(row_stop, rows, offsets[:, 2] + 1)
+
+        Z, Y, X = array.shape
+        threads = 128
+        blocks = (Z*Y + threads - 1) // threads
+        _stamp_balls_gpu(array.dtype)(
+                    (blocks,), (threads,), 
+                    (array, 
+                     cupy.ascontiguousarray(cupy.asarray(locations, dtype=cupy.int64)), 
+                     cupy.asarray(labels, dtype=array.dtype), 
+                     np.int64(len(locations)), 
+                     cupy.asarray(row_start), 
+                     cupy.asarray(row_stop), 
+                     *(np.int64(n) for n in (lower[0], lower[1], nz, ny, Z, Y, X))))
 
     def compute_gt(self):
         """
             Computes the ground truth data, using the find_centres and 
-            draw_ball functions. 
+            draw_ball functions. Centres given directly as coordinates skip 
+            find_centres.
 
             Returns 
             -------------------
@@ -202,13 +501,60 @@ class GroundTruth():
                 An array containing the computed ground truth.
         """
 
-        hand_labelled_data = self.pos_data + self.neg_data
+        vesicle_centres = []
+        labels = []
+
+        # Find the centres of any hand labelled data. Napari can hand over non 
+        # C-contiguous arrays (e.g. from sub-selections), so make sure the full volume 
+        # passes below run over contiguous memory.
+        pos_data, neg_data = (None if data is None else np.ascontiguousarray(data) 
+                              for data in (self.pos_data, self.neg_data))
+        if pos_data is not None or neg_data is not None:
+            # Rather than adding the full pos and neg volumes, mark whether each voxel 
+            # is hand labelled PC+ (1), PC- (2) or both (3) in a compact array 
+            hand_labelled_classes = np.zeros(self.shape, dtype=np.uint8)
+            for data, value in ((pos_data, 1), (neg_data, 2)):
+                if data is not None:
+                    hand_labelled_classes[data != 0] |= value
+
+            found_centres = self.find_centres(data = hand_labelled_classes)
+            vesicle_centres.append(found_centres)
+
+            # Only look up the hand labelled values at the centres found, summing 
+            # in int64 so uint8 layers do not wrap
+            index = tuple(found_centres.T)
+            labels.append(sum(data[index].astype(np.int64) 
+                              for data in (pos_data, neg_data) if data is not None))
+
+        # Add any centres that were given directly
+        for centres, label in ((self.pos_centres, POS_LABEL), (self.neg_centres, NEG_LABEL)):
+            if centres is not None:
+                centres = np.round(np.asarray(centres)).astype(np.int64).reshape(-1, len(self.shape))
+                vesicle_centres.append(centres)
+                labels.append(np.full(len(centres), label))
+
+        # Only a handful of label values are used, so store the ground truth as uint8, 
+        # unless hand labelled values too large for it were used
+        dtype = np.uint8
+        if len(labels) > 0:
+            vesicle_centres = np.concatenate(vesicle_centres)
+            labels = np.concatenate(labels)
+            if labels.size > 0 and labels.max() > np.iinfo(np.uint8).max:
+                dtype = labels.dtype
+
+        if self.device == 'cuda':
+            ground_truth = cupy.zeros(self.shape, dtype=dtype)
+        else:
+            ground_truth = np.zeros(self.shape, dtype=dtype)
 
-        self.ground_truth = np.zeros(hand_labelled_data.shape, dtype=np.int64)
+        if len(vesicle_centres) > 0:
+            self.draw_ball(
+                        array=ground_truth, 
+                        locations=vesicle_centres, 
+                        labels=labels)
 
-        vesicle_centres = self.find_centres(data = hand_labelled_data)
-        for i in range (len(vesicle_centres)):
-            loc = tuple(vesicle_centres[i])
-            self.draw_ball(array=self.ground_truth, location=loc, label=hand_labelled_data[loc])
+        if self.device == 'cuda':
+            ground_truth = cupy.asnumpy(ground_truth)
+        self.ground_truth = ground_truth
 
         return self.ground_truth
\ No newline at end of file
@@ -0,0 +1,388 @@
+import napari 
+import numpy as np
+import tifffile
+import os 
+from magicgui import magicgui
+import pathlib
+
+from src.groundtruth import GroundTruth, POS_LABEL, NEG_LABEL
+
+# Smallest (y,x) size of the lowest resolution level in a multiscale pyramid
+MIN_PYRAMID_SIZE = 256
+MAX_PYRAMID_LEVELS = 4
+
+def _to_pyramid(data):
+    """
+        Build a multiscale pyramid from data, halving the size of the (y,x) axes at 
+        each level, so that Napari only has to render the level matching the 
+        current zoom. The z axis is left at full resolution, so every level has the 
+        same slices as the label layers. Levels are strided views of data, so no 
+        copies are made. 
+        Levels are added until the (y,x) size would drop below MIN_PYRAMID_SIZE.
+
+        Returns 
+        -------------------
+        pyramid (list(array)):
+            List of arrays, from full resolution to lowest resolution.
+    """
+
+    pyramid = [data]
+    factor = 2
+    while (len(pyramid) < MAX_PYRAMID_LEVELS 
+           and min(data.shape[-2:]) // factor >= MIN_PYRAMID_SIZE):
+        pyramid.append(data[..., ::factor, ::factor])
+        factor *= 2
+    return pyramid
+
+def _full_resolution(layer):
+    """
+        Return the full resolution data of a Napari layer, which may be multiscale.
+    """
+
+    if layer.multiscale:
+        return layer.data[0]
+    return layer.data
+
+def _centres_to_mask(centres, shape, label):
+    """
+        Materialise a dense label mask of the given shape from an (N, ndim) array of 
+        centre coordinates (e.g. the data of a Napari points layer), setting the voxel 
+        at each centre to label. 
+    """
+
+    mask = np.zeros(shape, dtype=np.uint8)
+    centres = np.round(centres).astype(np.int64)
+    inside = np.all((centres >= 0) & (centres < shape), axis=1)
+    mask[tuple(centres[inside].T)] = label
+    return mask
+
+def _write_labels(path, data, dtype=np.uint16):
+    """
+        Write label data to a TIF file as dtype. The data is cast and written one 
+        slice at a time (along the first, largest stride, axis), so a full size 
+        converted copy of the data is never held in memory. The strips of each 
+        slice are compressed in parallel, using all available CPUs.
+    """
+
+    slices = data.reshape((-1,) + data.shape[-2:])
+    tifffile.imwrite(
+                    path, 
+                    (label_slice.astype(dtype) for label_slice in slices), 
+                    shape=data.shape, 
+                    dtype=dtype, 
+                    bigtiff=True, 
+                    compression='zlib', 
+                    maxworkers=os.cpu_count())
+
+def _clear_centres_layer(viewer, name, shape, as_points, colour):
+    """
+        Reset the pos or neg layer called name, to an empty labels layer of the given 
+        shape or, if as_points is True, an empty points layer. Points layers only store 
+        the centre coordinates, so use far less memory than a full size labels layer. 
+        The layer is created if it does not exist, and replaced if it is of the other type.
+    """
+
+    layer_type = napari.layers.Points if as_points else napari.layers.Labels
+    if as_points:
+        data = np.empty((0, len(shape)))
+    else:
+        data = np.zeros(shape, dtype=np.uint8)
+
+    if name in viewer.layers and isinstance(viewer.layers[name], layer_type):
+        viewer.layers[name].data = data
+        return
+
+    if name in viewer.layers:
+        viewer.layers.remove(viewer.layers[name])
+    if as_points:
+        viewer.add_points(data=data, name=name, ndim=len(shape), face_color=colour)
+    else:
+        viewer.add_labels(data=data, name=name)
+
+def read_tif(path):
+    """
+        Read a TIF file into memory, decoding pages in parallel.
+    """
+
+    return tifffile.imread(str(path), maxworkers=os.cpu_count())
+
+def memmap_tif(path):
+    """
+        Memory map a TIF file where possible, so only the regions that are used are 
+        ever read from disk. Compressed files can't be memory mapped, so are read 
+        into memory instead.
+    """
+
+    try:
+        return tifffile.memmap(str(path), mode='r')
+    except ValueError:
+        return read_tif(path)
+
+def make_get_gt(viewer):
+    """
+        Create the 'Compute GT' widget for viewer, which draws the ground truth 
+        vesicle spheres around the centres in the pos and neg layers.
+    """
+
+    @magicgui(call_button='Compute GT')
+    def get_gt(
+            vesicle_diameter = 300,
+            resolution_z=60,
+            resolution_y=60,
+            resolution_x=60, 
+            min_distance: int = 1, 
+            use_gpu: bool = False) -> napari.types.LayerDataTuple:
+        """
+            Computes the ground truth labelling layer, from the pos and neg layers.
+            The user sets the vesicle_diameter and the resolutions (in any consistent
+            measurement unit) using the provided boxes. The minimum distance between 
+            two labels to be considered independent vesicles is set using the min_distance
+            input. Ticking use_gpu computes the ground truth on the GPU, if one is 
+            available.
+
+            The ground truth label layer (called 'gt') is then generated by clicking the 
+            "Compute GT" call button. 
+        """
+    
+        pos = viewer.layers['pos']
+        neg = viewer.layers['neg']
+
+        # Points layers already hold the vesicle centres, labels layers need them finding
+        pos_points = isinstance(pos, napari.layers.Points)
+        neg_points = isinstance(neg, napari.layers.Points)
+        shape = None
+        if pos_points and neg_points:
+            shape = _full_resolution(viewer.layers['raw']).shape
+
+        ground_truth = GroundTruth(
+                                pos_data = None if pos_points else pos.data, 
+                                neg_data = None if neg_points else neg.data, 
+                                vesicle_diameter = vesicle_diameter,
+                                resolution = (resolution_z,resolution_y,resolution_x),
+                                min_distance=min_distance, 
+                                device='cuda' if use_gpu else 'cpu', 
+                                pos_centres = pos.data if pos_points else None, 
+                                neg_centres = neg.data if neg_points else None, 
+                                shape = shape)
+        gt = ground_truth.compute_gt()
+
+        # Return gt data as Napari label layer.
+        return (gt, {'name': 'gt'}, 'labels')
+
+    return get_gt
+
+def make_load_raw(viewer, reader=read_tif):
+    """
+        Create the widget for viewer that loads raw data into an image layer 'raw'. 
+        The TIF file is read with reader, e.g. read_tif or memmap_tif.
+    """
+
+    @magicgui(call_button='Load')
+    def load_raw(raw_data_path = pathlib.Path('path/to/raw.tif')):
+        """
+            Widget to allow the user to load in the raw data that is to be labelled. The data
+            must be a TIF file, and the path to this file provided. This can either be entered
+            manually, or using the dictionary navigation button.
+
+            Clicking the 'Load' call button will load the provided TIF file into a Napari image 
+            layer with name 'raw'.
+        """
+
+        raw_data = reader(raw_data_path)
+        pyramid = _to_pyramid(raw_data)
+        if len(pyramid) > 1:
+            raw = napari.layers.Image(data = pyramid, name='raw', multiscale=True)
+        else:
+            raw = napari.layers.Image(data = raw_data, name='raw')
+
+        if 'raw' in viewer.layers:
+            # Multiscale can only be set on layer creation, so swap in the new layer 
+            # at the same position
+            old_raw = viewer.layers['raw']
+            index = viewer.layers.index(old_raw)
+            viewer.layers.remove(old_raw)
+            viewer.layers.insert(index, raw)
+    
+        else: 
+            viewer.add_layer(raw)
+
+    return load_raw
+
+def make_load_labels(viewer):
+    """
+        Create the widget for viewer that loads saved pos and neg label layers.
+    """
+
+    @magicgui(call_button='Load')
+    def load_labels(pos_data_path = pathlib.Path('path/to/pos.tif'), 
+                    neg_data_path = pathlib.Path('path/to/neg.tif')):
+    
+        """
+            A widget to allow the user to load saved pos and neg label layers. Both the 
+            pos and neg files should be TIF files, and the paths can be provided either
+            manually or using dictionary navigation buttons. 
+
+            Clicking the 'Load' button will load the provided TIF files into Napari as
+            the pos and/or neg label layers. If these already exist, they will be overwritten.
+        """
+    
+        try:
+            pos_data = read_tif(pos_data_path)
+            # Check to see if pos label layer already exists
+            if 'pos' in viewer.layers and isinstance(viewer.layers['pos'], napari.layers.Labels):
+                pos = viewer.layers['pos']
+                pos.data = pos_data 
+            else:
+                if 'pos' in viewer.layers:
+                    # Replace a pos points layer
+                    viewer.layers.remove(viewer.layers['pos'])
+                pos = viewer.add_labels(data=pos_data, name='pos')
+        except:
+            if str(pos_data_path) == 'path/to/pos.tif' or str(pos_data_path) == '':
+                # If the path is unaltered or left blank, do nothing. Safetly to not accidently 
+                # overwrite pos layer if only want to load neg layer.
+                pass
+            else:
+                raise FileExistsError('Pos data location provided not suitable. Please try again.')
+        try:
+            neg_data = read_tif(neg_data_path)
+            # Check to see if neg label layer already exists
+            if 'neg' in viewer.layers and isinstance(viewer.layers['neg'], napari.layers.Labels):
+                neg = viewer.layers['neg']
+                neg.data = neg_data 
+            else: 
+                if 'neg' in viewer.layers:
+                    # Replace a neg points layer
+                    viewer.layers.remove(viewer.layers['neg'])
+                neg = viewer.add_labels(data=neg_data, name='neg')
+        except:
+            if str(neg_data_path) == 'path/to/neg.tif' or str(neg_data_path) == '':
+                # If the path is unaltered or left blank, do nothing. Safetly to not accidently 
+                # overwrite neg layer if only want to load pos layer.
+                pass
+            else:
+                raise FileExistsError('Neg data location provided not suitable. Please try again.')
+
+    return load_labels
+
+def make_save_centres(viewer):
+    """
+        Create the widget for viewer that saves the pos and neg layers as TIF files.
+    """
+
+    @magicgui(save_location ={'mode': 'd'}, call_button='Save centres')
+    def save_centres(save_location = pathlib.Path('save/location')):
+        """
+            Widget to allow user to save their pos and neg label layers as TIF files. The 
+            dictionary in which they wish to save their files is provided either manually, 
+            or using the navigation button. 
+
+            Clicking the 'Save centres' button will generate two files, pos.tif and neg.tif, 
+            within the provided directory. Existing files with those names will be overwritten.
+        """
+
+        pos = viewer.layers['pos']
+        neg = viewer.layers['neg']
+
+        if not os.path.exists(save_location):
+            os.makedirs(save_location)
+
+        # Points layers are saved as label masks, so they can be loaded back with load_labels
+        if isinstance(pos, napari.layers.Points) or isinstance(neg, napari.layers.Points):
+            raw_shape = _full_resolution(viewer.layers['raw']).shape
+
+        if isinstance(pos, napari.layers.Points):
+            pos_data = _centres_to_mask(pos.data, raw_shape, POS_LABEL)
+        else:
+            pos_data = pos.data
+        if isinstance(neg, napari.layers.Points):
+            neg_data = _centres_to_mask(neg.data, raw_shape, NEG_LABEL)
+        else:
+            neg_data = neg.data
+
+        _write_labels(f'{save_location}/pos.tif', pos_data)
+        _write_labels(f'{save_location}/neg.tif', neg_data)
+
+    return save_centres
+
+def make_clear_centres(viewer):
+    """
+        Create the widget for viewer that clears (or creates) the pos and neg layers.
+    """
+
+    @magicgui(call_button='Clear centres')
+    def clear_centres(Pos: bool = False, 
+                      Neg: bool = False, 
+                      As_points: bool = False):
+        """
+            A widget to allow the user to generate a clean pos and/or neg label layer. Only
+            layers that have the corresponding tick box checked will be affected. This widget 
+            can be used to generate the pos and neg label layers at the start, if previously 
+            saved ones are not to be loaded. If As_points is ticked, points layers are 
+            generated instead, on which vesicle centres are marked by adding points.
+        """
+    
+        raw_shape = _full_resolution(viewer.layers['raw']).shape
+        if Pos == True:
+            _clear_centres_layer(viewer, 'pos', raw_shape, As_points, colour='red')
+
+        if Neg == True:
+            _clear_centres_layer(viewer, 'neg', raw_shape, As_points, colour='blue')
+
+    return clear_centres
+
+def make_preview_crop(viewer):
+    """
+        Create the widget for viewer that previews and saves crops of the raw data.
+    """
+
+    @magicgui(save_location ={'mode': 'd'}, call_button='Run')
+    def preview_crop(
+                    shape_layer: 'napari.layers.Shapes',
+                    start_slice: int, 
+                    end_slice: int,
+                    name: str = 'cropped_image_name',
+                    save_location = pathlib.Path('save/location'),
+                    save: bool = False,
+                    preview: bool = False
+                    ):
+    
+        """
+            Widget to crop the raw data to the first rectangle in shape_layer, between 
+            start_slice and end_slice. The rectangle is expected to be drawn in the (y,x) 
+            plane of the (z,y,x) raw data, so its vertices give the (y,x) bounds of the 
+            crop. Ticking preview shows the cropped data as a new image layer, and ticking 
+            save writes it (along with its offset) to save_location/name.
+        """
+
+        # Integer (y,x) bounds of the rectangle, whichever way round it was drawn
+        vertices = np.asarray(shape_layer.data[0])
+        y0, x0 = np.floor(vertices.min(axis=0)[1:]).astype(int)
+        y1, x1 = np.ceil(vertices.max(axis=0)[1:]).astype(int)
+
+        raw_data = _full_resolution(viewer.layers['raw'])
+
+        # Only the cropped region is read if the raw data is memory mapped
+        cropped_data = np.ascontiguousarray(raw_data[start_slice: end_slice, y0: y1, x0: x1])
+    
+        if preview == True:
+            viewer.add_image(data=cropped_data, 
+                             name=name, 
+                             translate=(start_slice, y0, x0),
+                             colormap='green')
+
+        if save == True:
+            if not os.path.exists(f'{save_location}/{name}'):
+                os.makedirs(f'{save_location}/{name}')
+
+            tifffile.imwrite(
+                            f'{save_location}/{name}/{name}.tif', 
+                            cropped_data, 
+                            bigtiff=True, 
+                            compression='zlib', 
+                            maxworkers=os.cpu_count())
+            file = open(f'{save_location}/{name}/offset.txt', 'w')
+            file.write(f'Image offset (to top-left): (z,y,x) = ({start_slice}, {y0}, {x0})')
+            file.close()
+
+    return preview_crop
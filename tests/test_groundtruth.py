@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+import skimage.morphology
+
+from src.groundtruth import GroundTruth, POS_LABEL, NEG_LABEL
+
+
+def _one_slice_dot(radius, shape=(8, 32, 32), centre=(4, 16, 16)):
+    data = np.zeros(shape, dtype=np.uint8)
+    dot = skimage.morphology.disk(radius).astype(bool)
+    z, y, x = centre
+    data[z, y - radius:y + radius + 1, x - radius:x + radius + 1][dot] = POS_LABEL
+    return data
+
+
+def _ground_truth(pos_data):
+    return GroundTruth(pos_data = pos_data, neg_data = None, 
+                       vesicle_diameter = 300, resolution = [60, 60, 60])
+
+
+@pytest.mark.parametrize('radius', [1, 2, 3, 4, 5])
+def test_one_slice_dot_gives_one_centre(radius):
+    pos_data = _one_slice_dot(radius)
+    gt = _ground_truth(pos_data)
+
+    centres = gt.find_centres(pos_data)
+    assert centres.tolist() == [[4, 16, 16]]
+
+    ground_truth = gt.compute_gt()
+    assert np.count_nonzero(ground_truth) == 81
+    assert set(np.unique(ground_truth)) == {0, POS_LABEL}
+
+
+def test_separate_dots_give_one_centre_each():
+    pos_data = _one_slice_dot(3) | _one_slice_dot(2, centre=(2, 5, 25))
+    centres = _ground_truth(pos_data).find_centres(pos_data)
+    assert sorted(centres.tolist()) == [[2, 5, 25], [4, 16, 16]]
+
+
+def test_empty_layers():
+    gt = GroundTruth(pos_data = np.zeros((4, 8, 8), dtype=np.uint8), 
+                     neg_data = np.zeros((4, 8, 8), dtype=np.uint8), 
+                     vesicle_diameter = 300, resolution = [60, 60, 60])
+    assert gt.find_centres(gt.pos_data).shape == (0, 3)
+    assert not gt.compute_gt().any()
+
+
+def test_pos_and_neg_labels_do_not_wrap():
+    pos_data = _one_slice_dot(3) * np.uint8(200)
+    neg_data = _one_slice_dot(3) * np.uint8(100)
+    gt = GroundTruth(pos_data = pos_data, neg_data = neg_data, 
+                     vesicle_diameter = 300, resolution = [60, 60, 60])
+    assert set(np.unique(gt.compute_gt())) == {0, 300}
+
+
+def test_pos_and_neg_centres_are_not_merged():
+    pos_data = np.zeros((10, 64, 64), dtype=np.uint8)
+    neg_data = np.zeros((10, 64, 64), dtype=np.uint8)
+    pos_data[5, 30, 32] = POS_LABEL
+    neg_data[5, 30, 30] = NEG_LABEL
+    gt = GroundTruth(pos_data = pos_data, neg_data = neg_data, 
+                     vesicle_diameter = 300, resolution = [60, 60, 60], 
+                     min_distance = 3)
+    assert set(np.unique(gt.compute_gt())) == {0, POS_LABEL, NEG_LABEL}
+
+
+def test_close_centres_of_the_same_class_are_merged():
+    pos_data = _one_slice_dot(2) | _one_slice_dot(1, centre=(4, 16, 21))
+    gt = GroundTruth(pos_data = pos_data, neg_data = None, 
+                     vesicle_diameter = 300, resolution = [60, 60, 60], 
+                     min_distance = 5)
+    assert gt.find_centres(pos_data).tolist() == [[4, 16, 16]]